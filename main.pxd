@@ -0,0 +1,16 @@
+# main.py を Cython でコンパイルする際の型宣言 (pure Python モード)
+# main.py 自体は変更せずにそのまま実行でき、ビルド時のみこの宣言が適用されます。
+# YAML や呼び出し元から渡される値 (テーブル名、クラス名、パスなど) は str 以外の場合も
+# あるため object のままとし、コード内で生成される文字列のみ str と宣言します。
+import cython
+
+cdef str _normalize_yaml_value(object value)
+
+@cython.locals(
+    yaml_type=str,
+    column_type_str=str,
+    args_str=str,
+)
+cpdef write_models_code(object yaml_path, object out_fp)
+
+cpdef str generate_models_code(object yaml_path)
@@ -1,34 +1,34 @@
 import yaml
 import os
 import re
-from typing import Dict, Any, List, Set
+import io
+import functools
+from typing import Dict, Any, List, Set, TextIO
 
 # --- 内部定数とヘルパー関数 ---
 
-# YAMLの型名とSQLAlchemyの型オブジェクト名のマッピング
-SQLA_TYPE_MAP: Dict[str, str] = {
-    "Integer": "Integer",
-    "String": "String",
-    "DateTime": "DateTime",
-    "Boolean": "Boolean",
-    "Float": "Float",
-    "Text": "Text",
-}
-
-# YAMLのデフォルト値文字列とSQLAlchemyの関数名のマッピング
-# このマップはfunc.*を識別するためにのみ使用し、インポート文字列には直接使いません
-SQLA_FUNC_MAP: Dict[str, str] = {
-    "func.now()": "func.now", # `func.now()`のような文字列を`func.now`にマッピング
-}
+# libyaml が利用可能な場合は C 実装のローダーを使い、なければ純 Python 版にフォールバック
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
+# サポートするSQLAlchemyの型名 (YAMLの型名をそのままSQLAlchemyの型名として使用)
+SQLA_TYPES: frozenset = frozenset(("Integer", "String", "DateTime", "Boolean", "Float", "Text"))
+
+# この接頭辞で始まるデフォルト値は SQLAlchemy の func.* として server_default に出力します
+_FUNC_PREFIX = "func."
+
+# 生成コード内のクラス docstring の区切り行
+_DOCSTRING_DELIM = '    """\n'
+
+@functools.lru_cache(maxsize=None)
 def _snake_to_pascal(snake_str: str) -> str:
     """
     snake_case 文字列を PascalCase (クラス名) に変換します。
     例: 'user_profile' -> 'UserProfile'
+    同じテーブル名は再生成のたびに繰り返し現れるため、結果をキャッシュします。
     """
     return "".join(word.capitalize() for word in snake_str.split('_'))
 
-def _normalize_yaml_value(value: Any) -> str:
+def _format_yaml_value(value: Any) -> str:
     """
     YAMLの値をPythonコードで安全に表現できる文字列に変換します。
     特に文字列のためにrepr()を使用します。
@@ -37,146 +37,269 @@ def _normalize_yaml_value(value: Any) -> str:
         return repr(value) # 文字列はクォーテーションで囲む
     return str(value) # その他の型はそのまま文字列に変換
 
-# --- メインのコード生成ロジック ---
+# 文字列の repr() だけをキャッシュする (0.0 と -0.0 のように等しくても str() が異なる値があるため)
+_repr_cached = functools.lru_cache(maxsize=512)(repr)
 
-def generate_models_code(yaml_path: str) -> str:
+def _normalize_yaml_value(value: Any) -> str:
     """
-    YAMLスキーマファイルからSQLAlchemy ORMモデルのPythonコードを生成します。
+    _format_yaml_value と同じ変換を行います。
+    デフォルト値やコメントは同じ文字列が繰り返し現れることが多いため、文字列のみ結果をキャッシュします。
+    """
+    if type(value) is str:
+        return _repr_cached(value)
+    return _format_yaml_value(value)
 
-    Args:
-        yaml_path: YAMLスキーマファイルのパス。
+def _schema_cache_path(yaml_path: str) -> str:
+    """
+    YAML と同じディレクトリに置くキャッシュファイルのパスを返します。
+    例: 'schema.yml' -> 'schema_cache.py'
+    """
+    stem = os.path.splitext(os.path.basename(yaml_path))[0]
+    return os.path.join(os.path.dirname(yaml_path), f"{stem}_cache.py")
 
-    Returns:
-        生成されたSQLAlchemyモデルのPythonコードを含む文字列。
+def _schema_source_key(yaml_path: str) -> tuple:
+    """
+    キャッシュの妥当性判定に使う (絶対パス, st_mtime_ns, st_size) を返します。
+    """
+    st = os.stat(yaml_path)
+    return (os.path.abspath(yaml_path), st.st_mtime_ns, st.st_size)
+
+def _load_schema_cache(cache_path: str, source_key: tuple) -> Any:
+    """
+    キャッシュに記録された YAML の (パス, 更新時刻, サイズ) が source_key と一致すれば、
+    解析済みのスキーマを返します。
+    キャッシュが無い、一致しない、または読み込めない場合は None を返します。
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            code = compile(f.read(), cache_path, 'exec')
+        namespace: Dict[str, Any] = {}
+        exec(code, namespace)
+        if namespace.get('SCHEMA_SOURCE') != source_key:
+            return None
+        return namespace['SCHEMA']
+    except (OSError, SyntaxError, ValueError, NameError, KeyError):
+        return None
+
+def _write_schema_cache(cache_path: str, source_key: tuple, schema: Dict[str, Any]) -> None:
+    """
+    解析済みのスキーマを SCHEMA = {...} 形式の Python モジュールとして書き出します。
+    読み込み時に照合できるよう、元の YAML の (パス, 更新時刻, サイズ) も記録します。
+    書き込みに失敗してもコード生成は継続します。
+    """
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            f.write("import datetime\n\n") # YAML の日付型を repr() したものを評価できるようにする
+            f.write(f"SCHEMA_SOURCE = {source_key!r}\n")
+            f.write(f"SCHEMA = {schema!r}\n")
+    except OSError:
+        pass
+
+# --- メインのコード生成ロジック ---
+
+def _load_schema(yaml_path: str) -> Dict[str, Any]:
+    """
+    YAMLスキーマファイルを読み込み、ルート構造を検証したスキーマを返します。
 
     Raises:
-        ValueError: YAMLスキーマが無効な場合や、不正なフォーマットの場合。
+        ValueError: ファイルが見つからない場合や、YAMLスキーマが無効な場合。
     """
     try:
-        with open(yaml_path, 'r', encoding='utf-8') as f:
-            schema: Dict[str, Any] = yaml.safe_load(f)
+        source_key = _schema_source_key(yaml_path)
     except FileNotFoundError:
         raise ValueError(f"エラー: YAMLスキーマファイル '{yaml_path}' が見つかりません。")
-    except yaml.YAMLError as e:
-        raise ValueError(f"エラー: YAMLスキーマファイル '{yaml_path}' の解析に失敗しました: {e}")
+
+    # 同じ YAML (パス・更新時刻・サイズが一致) のキャッシュがあれば、YAML の解析を省略する
+    cache_path = _schema_cache_path(yaml_path)
+    schema: Dict[str, Any] = _load_schema_cache(cache_path, source_key)
+
+    if schema is None:
+        try:
+            with open(yaml_path, 'r', encoding='utf-8') as f:
+                schema = yaml.load(f, Loader=Loader)
+        except FileNotFoundError:
+            raise ValueError(f"エラー: YAMLスキーマファイル '{yaml_path}' が見つかりません。")
+        except yaml.YAMLError as e:
+            raise ValueError(f"エラー: YAMLスキーマファイル '{yaml_path}' の解析に失敗しました: {e}")
+        _write_schema_cache(cache_path, source_key, schema)
 
     # スキーマのルート構造の基本的な検証
     if not isinstance(schema, dict) or 'tables' not in schema or not isinstance(schema['tables'], dict):
         raise ValueError("無効なYAMLスキーマ: 'tables' セクションが見つからないか、不正な形式です。")
+    return schema
+
+def _describe_bad_column(col_name: str, col_def: Any) -> str:
+    """
+    不正なカラム定義について、エラーメッセージ用の説明を返します。
+    """
+    if not isinstance(col_def, dict):
+        return f"'{col_name}' (不正な形式)"
+    if 'type' not in col_def:
+        return f"'{col_name}' ('type' がありません)"
+    return f"'{col_name}' (サポートされていないSQLAlchemyの型 '{col_def['type']}')"
 
-    # 動的に必要なインポートを収集
-    imports: Set[str] = set() 
+def _collect_imports(tables: Dict[str, Any]) -> List[str]:
+    """
+    テーブル定義を検証しながら、生成コードに必要なインポート文を収集します。
+    出力を書き始める前にすべての検証を済ませるため、コード生成より先に呼び出します。
 
+    Raises:
+        ValueError: テーブルやカラムの定義が不正な場合。
+    """
     used_sqlalchemy_types: Set[str] = set()
     # `func` モジュール全体をインポートする必要があるため、フラグで管理
-    needs_sqlalchemy_func_import: bool = False 
-
-    model_code_lines: List[str] = []
+    needs_sqlalchemy_func_import: bool = False
 
-    # 各テーブル定義を処理し、モデルクラスのコードを生成
-    for table_key_in_yaml, table_def in schema['tables'].items():
+    for table_key_in_yaml, table_def in tables.items():
         if not isinstance(table_def, dict):
             raise ValueError(f"テーブル '{table_key_in_yaml}' の定義が不正な形式です。")
-        
+
+        columns_def = table_def.get('columns')
+        if not isinstance(columns_def, dict):
+            raise ValueError(f"テーブル '{table_key_in_yaml}' には 'columns' セクションがないか、不正な形式です。")
+
+        # カラム定義の検証を先にまとめて行い、不正なカラムをすべて報告する
+        bad_columns = [
+            (col_name, col_def) for col_name, col_def in columns_def.items()
+            if not (isinstance(col_def, dict) and col_def.get('type') in SQLA_TYPES)
+        ]
+        if bad_columns:
+            raise ValueError(
+                f"テーブル '{table_key_in_yaml}' に不正なカラム定義があります: "
+                + ", ".join(_describe_bad_column(col_name, col_def) for col_name, col_def in bad_columns)
+            )
+
+        # 検証済みのため、以降はガードなしで処理できる
+        for col_def in columns_def.values():
+            used_sqlalchemy_types.add(col_def['type'])
+
+            default_val = col_def.get('default')
+            if type(default_val) is str and default_val.startswith(_FUNC_PREFIX):
+                # func.* が使われている場合は func モジュールのインポートが必要
+                needs_sqlalchemy_func_import = True
+
+    # 最終的なインポート文を生成
+    general_sqlalchemy_imports = sorted(used_sqlalchemy_types | {"Column"})
+    final_imports = [f"from sqlalchemy import {', '.join(general_sqlalchemy_imports)}"]
+
+    # func モジュールが必要な場合のみインポートを追加
+    if needs_sqlalchemy_func_import:
+        final_imports.append("from sqlalchemy.sql import func")
+    
+    final_imports.append("from sqlalchemy.ext.declarative import declarative_base")
+    # 各インポートは一度しか追加されないため重複除去は不要
+    final_imports.sort()
+    return final_imports
+
+def write_models_code(yaml_path: str, out_fp: TextIO) -> None:
+    """
+    YAMLスキーマファイルからSQLAlchemy ORMモデルのPythonコードを生成し、
+    ファイルオブジェクトに逐次書き込みます。
+
+    Args:
+        yaml_path: YAMLスキーマファイルのパス。
+        out_fp: 書き込み可能なファイルオブジェクト。
+
+    Raises:
+        ValueError: YAMLスキーマが無効な場合や、不正なフォーマットの場合。
+            検証は書き込み開始前に行われるため、この場合 out_fp には何も書き込まれません。
+    """
+    schema = _load_schema(yaml_path)
+    tables: Dict[str, Any] = schema['tables']
+    final_imports = _collect_imports(tables)
+
+    write = out_fp.write # ループ内での属性参照を避けるためローカルに束縛
+    write("\n".join(final_imports))
+    write("\n\nBase = declarative_base()\n")
+
+    # 各テーブル定義を処理し、モデルクラスのコードを書き込む
+    for table_key_in_yaml, table_def in tables.items():
         class_name = table_def.get('class_name', _snake_to_pascal(table_key_in_yaml))
         db_table_name = table_def.get('table_name', table_key_in_yaml.lower())
 
         table_description = table_def.get('description', '')
 
-        model_code_lines.append(f"class {class_name}(Base):")
+        # テーブルごとに行をローカルのリストへ集め、最後に一度だけ書き込む
+        tbl: List[str] = []
+        tbl_append = tbl.append
+
+        tbl_append(f"\nclass {class_name}(Base):\n")
         if table_description:
-            model_code_lines.append(f"    \"\"\"")
-            for line in table_description.strip().split('\n'):
-                model_code_lines.append(f"    {line.strip()}")
-            model_code_lines.append(f"    \"\"\"")
+            tbl_append(_DOCSTRING_DELIM)
+            # splitlines() は \r\n や \r の改行にも対応する
+            tbl.extend([f"    {line.strip()}\n" for line in table_description.strip().splitlines()])
+            tbl_append(_DOCSTRING_DELIM)
         
-        model_code_lines.append(f"    __tablename__ = '{db_table_name}'")
-        model_code_lines.append("")
-
-        columns_def = table_def.get('columns')
-        if not isinstance(columns_def, dict):
-            raise ValueError(f"テーブル '{table_key_in_yaml}' には 'columns' セクションがないか、不正な形式です。")
-
-        for col_name, col_def in columns_def.items():
-            if not isinstance(col_def, dict) or 'type' not in col_def:
-                raise ValueError(f"テーブル '{table_key_in_yaml}' のカラム '{col_name}' は不正な形式か、'type' がありません。")
+        tbl_append(f"    __tablename__ = '{db_table_name}'\n\n")
 
+        for col_name, col_def in table_def['columns'].items():
+            col_get = col_def.get # カラムごとのメソッド参照を一度にまとめる
             yaml_type = col_def['type']
-            if yaml_type not in SQLA_TYPE_MAP:
-                raise ValueError(f"サポートされていないSQLAlchemyの型 '{yaml_type}' がカラム '{col_name}' に指定されています。")
-            
-            used_sqlalchemy_types.add(SQLA_TYPE_MAP[yaml_type])
-            column_type_str = SQLA_TYPE_MAP[yaml_type]
+            column_type_str = yaml_type
 
             if yaml_type == "String" and 'length' in col_def:
                 column_type_str = f"String(length={col_def['length']})"
             
-            column_args: List[str] = []
+            # 型を先頭の引数として扱い、Column(...) の中身を一度の join で組み立てる
+            column_args: List[str] = [column_type_str]
 
-            if col_def.get('primary_key'):
+            if col_get('primary_key'):
                 column_args.append("primary_key=True")
-            if col_def.get('autoincrement'):
+            if col_get('autoincrement'):
                 column_args.append("autoincrement=True")
-            if col_def.get('nullable') is False:
+            if col_get('nullable') is False:
                 column_args.append("nullable=False")
-            if col_def.get('unique'):
+            if col_get('unique'):
                 column_args.append("unique=True")
             
             if 'default' in col_def:
                 default_val = col_def['default']
-                if isinstance(default_val, str) and default_val.startswith('func.'):
-                    # func.* が使われている場合は func モジュールのインポートが必要
-                    needs_sqlalchemy_func_import = True
+                if type(default_val) is str and default_val.startswith(_FUNC_PREFIX):
                     column_args.append(f"server_default={default_val}") 
                 else:
                     column_args.append(f"default={_normalize_yaml_value(default_val)}")
             
-            if col_def.get('index'):
+            if col_get('index'):
                 column_args.append("index=True")
             
             if 'comment' in col_def:
                 column_args.append(f"comment={_normalize_yaml_value(col_def['comment'])}")
 
             args_str = ", ".join(column_args)
-            if args_str:
-                 model_code_lines.append(f"    {col_name} = Column({column_type_str}, {args_str})")
-            else:
-                 model_code_lines.append(f"    {col_name} = Column({column_type_str})")
-        model_code_lines.append("")
+            tbl_append(f"    {col_name} = Column({args_str})\n")
 
-    # 最終的なインポート文を生成
-    general_sqlalchemy_imports = ["Column"]
-    if used_sqlalchemy_types:
-        for t in used_sqlalchemy_types:
-            if t not in general_sqlalchemy_imports:
-                general_sqlalchemy_imports.append(t)
-    
-    final_imports = [f"from sqlalchemy import {', '.join(sorted(general_sqlalchemy_imports))}"]
+        write("".join(tbl))
 
-    # func モジュールが必要な場合のみインポートを追加
-    if needs_sqlalchemy_func_import:
-        final_imports.append("from sqlalchemy.sql import func")
-    
-    final_imports.append("from sqlalchemy.ext.declarative import declarative_base")
-    final_imports = sorted(list(set(final_imports)))
+def generate_models_code(yaml_path: str) -> str:
+    """
+    YAMLスキーマファイルからSQLAlchemy ORMモデルのPythonコードを生成します。
+    write_models_code を文字列として受け取るための互換用ラッパーです。
 
-    full_code = "\n".join(final_imports)
-    full_code += "\n\n"
-    full_code += "Base = declarative_base()\n\n"
-    full_code += "\n".join(model_code_lines)
+    Args:
+        yaml_path: YAMLスキーマファイルのパス。
 
-    return full_code
+    Returns:
+        生成されたSQLAlchemyモデルのPythonコードを含む文字列。
+
+    Raises:
+        ValueError: YAMLスキーマが無効な場合や、不正なフォーマットの場合。
+    """
+    buf = io.StringIO()
+    write_models_code(yaml_path, buf)
+    return buf.getvalue()
 
 # --- メインの実行スクリプト ---
 
-if __name__ == "__main__":
+def run() -> None:
+    """
+    schema.yml (無ければサンプルを作成) から models.py を生成します。
+    Cython でビルドした拡張モジュールからも `import main; main.run()` で実行できます。
+    """
     current_dir = os.path.dirname(os.path.abspath(__file__))
     schema_path = os.path.join(current_dir, 'schema.yml')
     output_path = os.path.join(current_dir, 'models.py')
 
-    if not os.path.exists(schema_path):
-        print(f"'{schema_path}' が見つかりません。サンプルを作成します。")
-        sample_schema_content = """
+    sample_schema_content = """
 tables:
   User:
     table_name: users
@@ -196,28 +319,42 @@ tables:
       category: {type: String, length: 50, nullable: true, index: true, comment: "商品のカテゴリ。例: Electronics, Books"}
       stock_quantity: {type: Integer, nullable: false, default: 0, comment: "在庫数"}
 """
-                
-        with open(schema_path, "w", encoding="utf-8") as f:
+
+    # 存在確認とファイル作成を一度で行うため、排他モード ('x') で開く
+    try:
+        with open(schema_path, "x", encoding="utf-8") as f:
+            print(f"'{schema_path}' が見つかりません。サンプルを作成します。")
             f.write(sample_schema_content.strip())
         print(f"サンプル '{schema_path}' を作成しました。")
+    except FileExistsError:
+        pass
 
     try:
-        generated_code = generate_models_code(schema_path)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(generated_code)
+        # 生成コードをバッファ付きで逐次書き込む
+        # 検証エラー時に既存の models.py を壊さないよう、一時ファイルに書いてから置き換える
+        tmp_output_path = output_path + '.tmp'
+        try:
+            with open(tmp_output_path, 'w', buffering=1 << 16, encoding='utf-8') as f:
+                write_models_code(schema_path, f)
+            os.replace(tmp_output_path, output_path)
+        finally:
+            if os.path.exists(tmp_output_path):
+                os.remove(tmp_output_path)
         print(f"SQLAlchemy ORM モデルが '{output_path}' に正常に生成されました。")
 
-        if os.path.exists(output_path):
-            print("\n--- 生成された models.py の内容 (一部) ---")
-            with open(output_path, "r", encoding="utf-8") as f:
-                for _ in range(30):
-                    line = f.readline()
-                    if not line:
-                        break
-                    print(line.rstrip())
-            print("------------------------------------------")
+        print("\n--- 生成された models.py の内容 (一部) ---")
+        with open(output_path, "r", encoding="utf-8") as f:
+            for _ in range(30):
+                line = f.readline()
+                if not line:
+                    break
+                print(line.rstrip())
+        print("------------------------------------------")
 
     except ValueError as e:
         print(f"エラー: モデル生成に失敗しました - {e}")
     except Exception as e:
         print(f"予期せぬエラーが発生しました: {e}")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,15 @@
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+# main.py を Cython でコンパイルします (任意)。
+# Cython やCコンパイラが無い環境では、従来どおり main.py がそのまま使われます。
+# ビルド方法: python setup.py build_ext --inplace
+setup(
+    name="orm_study",
+    ext_modules=cythonize(
+        [Extension("main", ["main.py"])],
+        language_level=3,
+        # main.py の型ヒントは実行時に強制しない (main.pxd の宣言のみを使う)
+        compiler_directives={"annotation_typing": False},
+    ),
+)
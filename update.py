@@ -1,12 +1,16 @@
 import re
+import hashlib
 import os
 import sys
-import yaml
 import subprocess
+import tempfile
+import pathlib
+import functools
 from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from typing import Dict, Any, List, Set, Optional
+from typing import Dict, Any, List, Set, Optional, Tuple
+
+# yaml や sqlalchemy は読み込みに時間がかかるため、使用する関数の中でインポートします。
+# (モデル生成だけを使う場合に sqlalchemy を、CRUD だけを使う場合に yaml を読み込まずに済む)
 
 # ---------------------------------------------------
 # 1. 内部設定とヘルパー関数
@@ -24,6 +28,18 @@ ALEMBIC_ENV_PY = os.path.join(ALEMBIC_DIR, 'env.py')
 # 生成されるモデルファイルのパス
 MODELS_PY_PATH = 'models.py'
 
+# models.py の先頭行に書き込む、生成元スキーマのハッシュのプレフィックス
+SCHEMA_HASH_PREFIX = '# schema-hash: '
+
+# generate_models_code の出力形式のバージョン
+# 同じスキーマでも出力が変わる変更を generate_models_code に加えた場合は、既存の models.py を
+# 再生成させるために値を上げてください (スキーマのハッシュにも含まれます)。
+MODELS_GENERATOR_VERSION = 2
+
+# Alembic 設定ファイルの書き換えに使う正規表現 (呼び出しごとのパターン解析を避けるため事前にコンパイル)
+_SQLA_URL_RE = re.compile(r'^sqlalchemy\.url\s*=.*$', re.MULTILINE)
+_TARGET_META_RE = re.compile(r'target_metadata = None')
+
 # YAMLの型名とSQLAlchemyの型オブジェクト名のマッピング
 SQLA_TYPE_MAP: Dict[str, str] = {
     "Integer": "Integer",
@@ -39,16 +55,212 @@ SQLA_FUNC_MAP: Dict[str, str] = {
     "func.now()": "func.now",
 }
 
+# カラム定義にキーが存在しないことを表す番兵 (None は有効な値として扱うため)
+_MISSING = object()
+
 def _snake_to_pascal(snake_str: str) -> str:
     """snake_case 文字列を PascalCase (クラス名) に変換します。"""
     return "".join(word.capitalize() for word in snake_str.split('_'))
 
+@functools.lru_cache(maxsize=None)
+def _get_yaml_loader() -> Any:
+    """
+    YAML ローダーを返します。インポートとローダーの選択は初回呼び出し時に一度だけ行います。
+    libyaml が利用可能な場合は C 実装のローダーを使い、なければ純 Python 版にフォールバックします。
+    """
+    try:
+        from yaml import CSafeLoader as loader
+    except ImportError:
+        from yaml import SafeLoader as loader
+    return loader
+
 def _normalize_yaml_value(value: Any) -> str:
     """YAMLの値をPythonコードで安全に表現できる文字列に変換します。"""
     if isinstance(value, str):
         return repr(value)
     return str(value)
 
+def _schema_hash(yaml_content: str) -> str:
+    """
+    YAMLコンテンツと生成器のバージョンから、'<バージョン>:<ハッシュ値>' 形式の文字列を返します。
+    """
+    payload = f"{MODELS_GENERATOR_VERSION}\n{yaml_content}"
+    digest = hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+    return f"{MODELS_GENERATOR_VERSION}:{digest}"
+
+def _read_schema_hash(models_path: str) -> Optional[str]:
+    """生成済みの models.py の先頭行からスキーマのハッシュ値を読み取ります。無ければ None を返します。"""
+    try:
+        with open(models_path, 'r', encoding='utf-8') as f:
+            first_line = f.readline().rstrip('\n')
+    except FileNotFoundError:
+        return None
+    if first_line.startswith(SCHEMA_HASH_PREFIX):
+        return first_line[len(SCHEMA_HASH_PREFIX):]
+    return None
+
+def _write_if_changed(path: str, old_content: str, new_content: str) -> bool:
+    """
+    内容が変わる場合のみファイルを書き換えます。書き換えたかどうかを返します。
+    一時ファイルに書いてから置き換えるため、途中で失敗しても元のファイルは壊れません。
+    """
+    if new_content == old_content:
+        return False
+    tmp = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', delete=False)
+    try:
+        with tmp:
+            tmp.write(new_content)
+        os.chmod(tmp.name, os.stat(path).st_mode & 0o777) # 元のパーミッションを引き継ぐ
+        os.replace(tmp.name, path)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return True
+
+# 各階層で generate_models_code が参照するキー (それ以外のキーは値を構築せずに読み飛ばす)
+# None の階層ではすべてのキーを保持する (テーブル名・カラム名など)
+_SCHEMA_KEYS: Dict[str, Optional[frozenset]] = {
+    'root': frozenset({'tables'}),
+    'table': frozenset({'class_name', 'table_name', 'description', 'columns'}),
+    'column': frozenset({
+        'type', 'length', 'primary_key', 'autoincrement', 'nullable',
+        'unique', 'default', 'index', 'comment',
+    }),
+}
+
+# マッピングがキーを待っている状態 / 読み飛ばす値を待っている状態を表す番兵
+_NO_KEY = object()
+_SKIP_VALUE = object()
+
+# タグが明示されていないことを表すイベントの tag 値 (None または非特定タグ '!')
+_PLAIN_TAGS = (None, '!')
+
+class _UnsupportedSchemaYAML(Exception):
+    """イベントベースの解析が対応していない YAML 構文 (エイリアス、複合キーなど) が現れたことを表します。"""
+
+def _child_role(role: str, key: Any) -> str:
+    """親コンテナの役割とキーから、子コンテナの役割を求めます。"""
+    if role == 'root' and key == 'tables':
+        return 'tables'
+    if role == 'tables':
+        return 'table'
+    if role == 'table' and key == 'columns':
+        return 'columns'
+    if role == 'columns':
+        return 'column'
+    return 'any'
+
+def _parse_schema_events(yaml_content: str) -> Any:
+    """
+    libyaml のイベント (CParser) を直接たどり、コード生成に必要なキーだけで
+    スキーマの辞書を組み立てます。ノードツリー全体を構築する yaml.load より軽量です。
+
+    Raises:
+        yaml.YAMLError: YAML の構文が不正な場合。
+        _UnsupportedSchemaYAML: libyaml が使えない場合や、対応していない構文が含まれる場合。
+    """
+    import yaml
+    from yaml.events import (
+        AliasEvent, DocumentStartEvent, MappingStartEvent, ScalarEvent,
+        SequenceStartEvent, CollectionEndEvent,
+    )
+
+    try:
+        from yaml.cyaml import CParser
+    except ImportError:
+        raise _UnsupportedSchemaYAML("libyaml が利用できません。")
+
+    resolver = yaml.resolver.Resolver()
+    constructor = yaml.constructor.SafeConstructor()
+    str_tag = 'tag:yaml.org,2002:str'
+
+    root: Any = None
+    # 各要素は [コンテナ, 役割, 現在のキー]
+    stack: List[List[Any]] = []
+    skip_depth = 0
+    documents = 0
+
+    def add(value: Any) -> None:
+        nonlocal root
+        if not stack:
+            root = value
+            return
+        frame = stack[-1]
+        container = frame[0]
+        if type(container) is list:
+            container.append(value)
+        elif frame[2] is _NO_KEY:
+            allowed = _SCHEMA_KEYS.get(frame[1])
+            frame[2] = value if allowed is None or value in allowed else _SKIP_VALUE
+        else:
+            container[frame[2]] = value
+            frame[2] = _NO_KEY
+
+    for ev in yaml.parse(yaml_content, Loader=CParser):
+        # 未定義のエイリアスの検出などは yaml.load に任せるため、読み飛ばし中でも中断する
+        if isinstance(ev, AliasEvent):
+            raise _UnsupportedSchemaYAML("エイリアスには対応していません。")
+
+        # 不要なキーの値 (入れ子を含む) は何も構築せずに読み飛ばす
+        if skip_depth:
+            if getattr(ev, 'tag', None) not in _PLAIN_TAGS:
+                # 明示的なタグは yaml.load が拒否する場合があるため、解析を任せる
+                raise _UnsupportedSchemaYAML(f"タグ '{ev.tag}' には対応していません。")
+            if isinstance(ev, (MappingStartEvent, SequenceStartEvent)):
+                skip_depth += 1
+            elif isinstance(ev, CollectionEndEvent):
+                skip_depth -= 1
+            continue
+
+        if isinstance(ev, ScalarEvent):
+            tag = ev.tag
+            if stack and stack[-1][2] is _SKIP_VALUE:
+                if tag not in _PLAIN_TAGS:
+                    raise _UnsupportedSchemaYAML(f"タグ '{tag}' には対応していません。")
+                stack[-1][2] = _NO_KEY
+                continue
+            if tag in _PLAIN_TAGS:
+                tag = resolver.resolve(yaml.ScalarNode, ev.value, ev.implicit)
+            if tag == str_tag:
+                add(ev.value)
+            elif tag == 'tag:yaml.org,2002:merge':
+                raise _UnsupportedSchemaYAML("マージキーには対応していません。")
+            else:
+                add(constructor.construct_object(
+                    yaml.ScalarNode(tag, ev.value, start_mark=ev.start_mark, end_mark=ev.end_mark)
+                ))
+
+        elif isinstance(ev, (MappingStartEvent, SequenceStartEvent)):
+            if stack:
+                frame = stack[-1]
+                if frame[2] is _SKIP_VALUE:
+                    if ev.tag not in _PLAIN_TAGS:
+                        raise _UnsupportedSchemaYAML(f"タグ '{ev.tag}' には対応していません。")
+                    frame[2] = _NO_KEY
+                    skip_depth = 1
+                    continue
+                if type(frame[0]) is dict and frame[2] is _NO_KEY:
+                    raise _UnsupportedSchemaYAML("複合キーには対応していません。")
+                role = 'any' if type(frame[0]) is list else _child_role(frame[1], frame[2])
+            else:
+                role = 'root'
+            if ev.tag not in _PLAIN_TAGS and ev.tag not in ('tag:yaml.org,2002:map', 'tag:yaml.org,2002:seq'):
+                raise _UnsupportedSchemaYAML(f"タグ '{ev.tag}' には対応していません。")
+            container: Any = {} if isinstance(ev, MappingStartEvent) else []
+            add(container)
+            stack.append([container, role, _NO_KEY])
+
+        elif isinstance(ev, CollectionEndEvent):
+            stack.pop()
+
+        elif isinstance(ev, DocumentStartEvent):
+            documents += 1
+            if documents > 1:
+                # 複数ドキュメントのエラー報告は yaml.load に任せる
+                raise _UnsupportedSchemaYAML("複数のドキュメントには対応していません。")
+
+    return root
+
 # ---------------------------------------------------
 # 2. モデルコード生成関数 (generate_models_code)
 # ---------------------------------------------------
@@ -56,8 +268,13 @@ def generate_models_code(yaml_content: str) -> str:
     """
     YAMLコンテンツからSQLAlchemy ORMモデルのPythonコードを生成します。
     """
+    import yaml
+
     try:
-        schema: Dict[str, Any] = yaml.safe_load(yaml_content)
+        try:
+            schema: Dict[str, Any] = _parse_schema_events(yaml_content)
+        except _UnsupportedSchemaYAML:
+            schema = yaml.load(yaml_content, Loader=_get_yaml_loader())
     except yaml.YAMLError as e:
         raise ValueError(f"エラー: YAMLスキーマコンテンツの解析に失敗しました: {e}")
 
@@ -68,76 +285,82 @@ def generate_models_code(yaml_content: str) -> str:
     used_sqlalchemy_types: Set[str] = set()
     needs_sqlalchemy_func_import: bool = False
 
-    model_code_lines: List[str] = []
+    # テーブルごとのクラス定義ブロック
+    table_blocks: List[str] = []
 
     for table_key_in_yaml, table_def in schema['tables'].items():
         if not isinstance(table_def, dict):
             raise ValueError(f"テーブル '{table_key_in_yaml}' の定義が不正な形式です。")
         
-        class_name = table_def.get('class_name', _snake_to_pascal(table_key_in_yaml))
+        # class_name が指定されている場合は変換処理を行わない
+        class_name = table_def.get('class_name') or _snake_to_pascal(table_key_in_yaml)
         db_table_name = table_def.get('table_name', table_key_in_yaml.lower())
 
         table_description = table_def.get('description', '')
 
-        model_code_lines.append(f"class {class_name}(Base):")
+        docstring = ""
         if table_description:
-            model_code_lines.append(f"    \"\"\"")
-            for line in table_description.strip().split('\n'):
-                model_code_lines.append(f"    {line.strip()}")
-            model_code_lines.append(f"    \"\"\"")
-        
-        model_code_lines.append(f"    __tablename__ = '{db_table_name}'")
-        model_code_lines.append("")
+            description_lines = "\n".join([f"    {line.strip()}" for line in table_description.strip().split('\n')])
+            docstring = f"    \"\"\"\n{description_lines}\n    \"\"\"\n"
 
         columns_def = table_def.get('columns')
         if not isinstance(columns_def, dict):
             raise ValueError(f"テーブル '{table_key_in_yaml}' には 'columns' セクションがないか、不正な形式です。")
 
+        col_lines: List[str] = []
         for col_name, col_def in columns_def.items():
             if not isinstance(col_def, dict) or 'type' not in col_def:
                 raise ValueError(f"テーブル '{table_key_in_yaml}' のカラム '{col_name}' は不正な形式か、'type' がありません。")
 
+            _get = col_def.get # カラムごとのメソッド参照を一度にまとめる
             yaml_type = col_def['type']
-            if yaml_type not in SQLA_TYPE_MAP:
+            # 存在確認と取得を一度の辞書参照で行う
+            try:
+                column_type_str = SQLA_TYPE_MAP[yaml_type]
+            except KeyError:
                 raise ValueError(f"サポートされていないSQLAlchemyの型 '{yaml_type}' がカラム '{col_name}' に指定されています。")
             
-            used_sqlalchemy_types.add(SQLA_TYPE_MAP[yaml_type])
-            column_type_str = SQLA_TYPE_MAP[yaml_type]
+            used_sqlalchemy_types.add(column_type_str)
 
-            if yaml_type == "String" and 'length' in col_def:
-                column_type_str = f"String(length={col_def['length']})"
+            # `in` による確認と取得の二重参照を避けるため、番兵を使って一度で取得する
+            length = _get('length', _MISSING)
+            if yaml_type == "String" and length is not _MISSING:
+                column_type_str = f"String(length={length})"
             
             column_args: List[str] = []
 
-            if col_def.get('primary_key'):
+            if _get('primary_key'):
                 column_args.append("primary_key=True")
-            if col_def.get('autoincrement'):
+            if _get('autoincrement'):
                 column_args.append("autoincrement=True")
-            if col_def.get('nullable') is False:
+            if _get('nullable') is False:
                 column_args.append("nullable=False")
-            if col_def.get('unique'):
+            if _get('unique'):
                 column_args.append("unique=True")
             
-            if 'default' in col_def:
-                default_val = col_def['default']
+            default_val = _get('default', _MISSING)
+            if default_val is not _MISSING:
                 if isinstance(default_val, str) and default_val.startswith('func.'):
                     needs_sqlalchemy_func_import = True
                     column_args.append(f"server_default={default_val}") 
                 else:
                     column_args.append(f"default={_normalize_yaml_value(default_val)}")
             
-            if col_def.get('index'):
+            if _get('index'):
                 column_args.append("index=True")
             
-            if 'comment' in col_def:
-                column_args.append(f"comment={_normalize_yaml_value(col_def['comment'])}")
+            comment = _get('comment', _MISSING)
+            if comment is not _MISSING:
+                column_args.append(f"comment={_normalize_yaml_value(comment)}")
 
             args_str = ", ".join(column_args)
-            if args_str:
-                 model_code_lines.append(f"    {col_name} = Column({column_type_str}, {args_str})")
-            else:
-                 model_code_lines.append(f"    {col_name} = Column({column_type_str})")
-        model_code_lines.append("")
+            col_lines.append(f"    {col_name} = Column({column_type_str}{', ' + args_str if args_str else ''})\n")
+
+        # クラス定義全体を一つの文字列として組み立てる
+        table_blocks.append(
+            f"class {class_name}(Base):\n{docstring}    __tablename__ = '{db_table_name}'\n\n"
+            + "".join(col_lines)
+        )
 
     general_sqlalchemy_imports = ["Column"]
     if used_sqlalchemy_types:
@@ -145,20 +368,17 @@ def generate_models_code(yaml_content: str) -> str:
             if t not in general_sqlalchemy_imports:
                 general_sqlalchemy_imports.append(t)
     
+    # 各インポートは一度しか追加されないため、重複除去や並べ替えをせず固定の順序で組み立てる
     final_imports = [f"from sqlalchemy import {', '.join(sorted(general_sqlalchemy_imports))}"]
 
     if needs_sqlalchemy_func_import:
         final_imports.append("from sqlalchemy.sql import func")
     
     final_imports.append("from sqlalchemy.ext.declarative import declarative_base")
-    final_imports = sorted(list(set(final_imports)))
-
-    full_code = "\n".join(final_imports)
-    full_code += "\n\n"
-    full_code += "Base = declarative_base()\n\n"
-    full_code += "\n".join(model_code_lines)
 
-    return full_code
+    # 文字列の += による再確保を避け、各部分を一度の join で連結する
+    parts = ["\n".join(final_imports), "", "Base = declarative_base()", "", "\n".join(table_blocks)]
+    return "\n".join(parts)
 
 # ---------------------------------------------------
 # 3. Alembic セットアップ関数
@@ -166,12 +386,13 @@ def generate_models_code(yaml_content: str) -> str:
 def setup_alembic():
     """Alembic環境を初期化し、設定ファイルを準備します。"""
     if not os.path.exists(ALEMBIC_DIR):
-        print(f"Alembic環境を初期化中: '{ALEMBIC_DIR}'...")
+        print(f"Alembic環境を初期化中: '{ALEMBIC_DIR}'...", flush=True)
         try:
-            subprocess.run(["alembic", "init", ALEMBIC_DIR], check=True, capture_output=True)
+            # 標準出力は不要なので捨て、エラー出力はそのまま端末に流す
+            subprocess.run(["alembic", "init", ALEMBIC_DIR], check=True, stdout=subprocess.DEVNULL)
             print("Alembic環境が正常に初期化されました。")
         except subprocess.CalledProcessError as e:
-            print(f"Alembic初期化エラー: {e.stderr.decode()}")
+            print(f"Alembic初期化エラー: 終了コード {e.returncode} (詳細は上記の出力を参照してください)")
             sys.exit(1)
     else:
         print(f"Alembic環境は既に存在します: '{ALEMBIC_DIR}'。")
@@ -179,21 +400,27 @@ def setup_alembic():
     # alembic.ini を設定
     with open(ALEMBIC_INI, 'r') as f:
         ini_content = f.read()
-    ini_content = re.sub(r'sqlalchemy.url = .*', f'sqlalchemy.url = {DATABASE_URL}', ini_content)
-    with open(ALEMBIC_INI, 'w') as f:
-        f.write(ini_content)
-    print(f"'{ALEMBIC_INI}' にデータベースURLを設定しました。")
+    new_ini_content = _SQLA_URL_RE.sub(f'sqlalchemy.url = {DATABASE_URL}', ini_content)
+    if _write_if_changed(ALEMBIC_INI, ini_content, new_ini_content):
+        print(f"'{ALEMBIC_INI}' にデータベースURLを設定しました。")
+    else:
+        print(f"'{ALEMBIC_INI}' のデータベースURLは設定済みです。")
 
     # alembic/env.py を設定
     with open(ALEMBIC_ENV_PY, 'r') as f:
         env_content = f.read()
 
+    # 既に設定済みであれば書き換えない
+    if "import models" in env_content and env_content.startswith("import os,sys"):
+        print(f"'{ALEMBIC_ENV_PY}' は設定済みです。")
+        return
+
+    new_env_content = env_content
     # Base をインポートする行と sys.path の追加
     # idempotency を考慮し、既に存在する場合は追加しない
-    if "import models" not in env_content:
+    if "import models" not in new_env_content:
         # target_metadata の設定行を探し、その直前に挿入する
-        env_content = re.sub(
-            r'target_metadata = None',
+        new_env_content = _TARGET_META_RE.sub(
             f'sys.path.append(os.path.abspath(os.path.dirname(__file__) + "/.."))\n'
             f'try:\n'
             f'    import models\n'
@@ -201,15 +428,15 @@ def setup_alembic():
             f'except ImportError:\n'
             f'    print("Error: Could not import models.py for Alembic. Ensure it is generated.", file=sys.stderr)\n'
             f'    sys.exit(1)\n',
-            env_content,
+            new_env_content,
             count=1 # 最初のマッチだけ置換
         )
         # 既存の `target_metadata = None` が残ってたら削除
-        env_content = env_content.replace('target_metadata = None', '')
-
+        new_env_content = new_env_content.replace('target_metadata = None', '')
+    if not new_env_content.startswith("import os,sys"):
+        new_env_content = "import os,sys\n" + new_env_content
 
-    with open(ALEMBIC_ENV_PY, 'w') as f:
-        f.write("import os,sys\n"+env_content)
+    _write_if_changed(ALEMBIC_ENV_PY, env_content, new_env_content)
     print(f"'{ALEMBIC_ENV_PY}' を更新しました。")
 
 
@@ -219,41 +446,44 @@ def setup_alembic():
 def run_alembic_migrations(message: str = "auto-generated migration"):
     """Alembic のリビジョンを生成し、データベースに適用します。"""
     print("\n--- Alembic マイグレーション実行 ---")
-    
+
+    # alembic コマンドを別プロセスで起動せず、Python API を同じプロセス内で呼び出す
+    # (インタプリタの起動と sqlalchemy の再インポートを省ける)
+    try:
+        from alembic import command
+        from alembic.config import Config
+    except ImportError:
+        print("エラー: Alembic をインポートできません。Alembicがインストールされていることを確認してください。")
+        sys.exit(1)
+
+    alembic_cfg = Config(ALEMBIC_INI)
+
+    # env.py の `import models` が前回の呼び出しでロードした古いモジュールを使わないよう、
+    # sys.modules から取り除いて現在の models.py を読み込み直させる
+    sys.modules.pop("models", None)
+
     # リビジョンの自動生成
     try:
-        print(f"Alembicリビジョンを自動生成中 (メッセージ: '{message}')...")
-        result = subprocess.run(
-            ["alembic", "-c", ALEMBIC_INI, "revision", "--autogenerate", "-m", message],
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        print(result.stdout)
-        if result.stderr:
-            print(f"Alembic revision warnings/errors:\n{result.stderr}")
-    except subprocess.CalledProcessError as e:
-        print(f"Alembicリビジョン生成エラー: {e.stderr}")
+        print(f"Alembicリビジョンを自動生成中 (メッセージ: '{message}')...", flush=True)
+        command.revision(alembic_cfg, message=message, autogenerate=True)
+    except SystemExit:
+        # env.py は models.py をインポートできない場合に sys.exit(1) で終了する
+        print("Alembicリビジョン生成エラー: env.py が異常終了しました (詳細は上記の出力を参照してください)")
         sys.exit(1)
-    except FileNotFoundError:
-        print("エラー: 'alembic' コマンドが見つかりません。Alembicがインストールされ、PATHが通っていることを確認してください。")
+    except Exception as e:
+        print(f"Alembicリビジョン生成エラー: {e}")
         sys.exit(1)
 
     # 生成されたリビジョンを適用
     try:
-        print("Alembicマイグレーションを適用中 ('alembic upgrade head')...")
-        result = subprocess.run(
-            ["alembic", "-c", ALEMBIC_INI, "upgrade", "head"],
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        print(result.stdout)
-        if result.stderr:
-            print(f"Alembic upgrade warnings/errors:\n{result.stderr}")
+        print("Alembicマイグレーションを適用中 ('alembic upgrade head')...", flush=True)
+        command.upgrade(alembic_cfg, "head")
         print("データベーススキーマが正常に更新されました。")
-    except subprocess.CalledProcessError as e:
-        print(f"Alembicマイグレーション適用エラー: {e.stderr}")
+    except SystemExit:
+        print("Alembicマイグレーション適用エラー: env.py が異常終了しました (詳細は上記の出力を参照してください)")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Alembicマイグレーション適用エラー: {e}")
         sys.exit(1)
 
 # ---------------------------------------------------
@@ -264,26 +494,46 @@ def run_alembic_migrations(message: str = "auto-generated migration"):
 User: Any = None
 Product: Any = None
 Base: Any = None
+# User のカラム属性名 (モデルのロード時に一度だけ求める)
+_USER_COLUMNS: Tuple[str, ...] = ()
+
+# ロード済みの models モジュールのキャッシュ ((パス, 更新時刻 ns) -> モジュール)
+_MODELS_MODULE_CACHE: Dict[Tuple[str, int], Any] = {}
 
 def load_models_dynamically():
     """
     生成された models.py からモデルを動的にインポートします。
     Alembicの実行後に呼び出されることを想定。
     """
-    global User, Product, Base
+    global User, Product, Base, _USER_COLUMNS
+    import importlib.util
+    from sqlalchemy import inspect
+
     try:
-        spec = importlib.util.spec_from_file_location("orm_models", MODELS_PY_PATH)
-        if spec is None:
-            raise ImportError(f"'{MODELS_PY_PATH}' の仕様をロードできませんでした。")
-        orm_models = importlib.util.module_from_spec(spec)
-        if spec.loader:
-            spec.loader.exec_module(orm_models)
-        else:
-            raise ImportError(f"'{MODELS_PY_PATH}' のローダーがありません。")
+        try:
+            cache_key = (MODELS_PY_PATH, os.stat(MODELS_PY_PATH).st_mtime_ns)
+        except FileNotFoundError:
+            raise ImportError(f"'{MODELS_PY_PATH}' が見つかりません。")
+
+        # models.py が変更されていなければ、前回ロードしたモジュールを再利用する
+        orm_models = _MODELS_MODULE_CACHE.get(cache_key)
+        if orm_models is None:
+            spec = importlib.util.spec_from_file_location("orm_models", MODELS_PY_PATH)
+            if spec is None:
+                raise ImportError(f"'{MODELS_PY_PATH}' の仕様をロードできませんでした。")
+            orm_models = importlib.util.module_from_spec(spec)
+            if spec.loader:
+                spec.loader.exec_module(orm_models)
+            else:
+                raise ImportError(f"'{MODELS_PY_PATH}' のローダーがありません。")
+            _MODELS_MODULE_CACHE[cache_key] = orm_models
+            # 以降の `import orm_models` で再実行されないよう登録しておく
+            sys.modules["orm_models"] = orm_models
 
         Base = orm_models.Base
         User = orm_models.User
         Product = orm_models.Product
+        _USER_COLUMNS = tuple(attr.key for attr in inspect(User).column_attrs)
 
         print("モデルを正常にロードしました。")
 
@@ -295,6 +545,27 @@ def load_models_dynamically():
         print(f"予期せぬエラー: モデルの動的ロード中にエラーが発生しました - {e}", file=sys.stderr)
         sys.exit(1)
 
+def _set_sqlite_pragmas(dbapi_conn, _connection_record):
+    """
+    SQLite 接続ごとに PRAGMA を設定します。
+    WAL モードと synchronous=NORMAL により、コミットごとの fsync を減らします。
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536") # 64MB
+    cursor.close()
+
+def _get_by_pk(session, model: Any, pk: Any) -> Any:
+    """
+    主キーで行を取得します。見つからない場合は None を返します。
+    pk が None の場合、session.get は SAWarning を出すため問い合わせずに None を返します。
+    """
+    if pk is None:
+        return None
+    return session.get(model, pk)
+
 # CRUD 関数 (models.py がロードされた後にのみ実行可能)
 def create_user(session, name: str, email: str, phone_number: Optional[str] = None) -> User:
     new_user = User(name=name, email=email, phone_number=phone_number)
@@ -304,8 +575,21 @@ def create_user(session, name: str, email: str, phone_number: Optional[str] = No
     print(f"作成: ユーザー ID={new_user.id}, 名前={new_user.name}, メール={new_user.email}, 電話={new_user.phone_number}, 作成日時={new_user.created_at}")
     return new_user
 
+def bulk_create_users(session, rows: List[Dict[str, Any]]) -> List[User]:
+    """複数のユーザーを作成し、一度のコミットでまとめて保存します。"""
+    from sqlalchemy import insert
+    # INSERT ... RETURNING で ID とサーバー側デフォルト値 (created_at) を同時に受け取り、
+    # refresh による再取得を不要にする
+    new_users = session.scalars(
+        insert(User).returning(User, sort_by_parameter_order=True), rows
+    ).all()
+    for new_user in new_users:
+        print(f"作成: ユーザー ID={new_user.id}, 名前={new_user.name}, メール={new_user.email}, 電話={new_user.phone_number}, 作成日時={new_user.created_at}")
+    session.commit()
+    return new_users
+
 def get_user_by_id(session, user_id: int) -> Optional[User]:
-    user = session.query(User).filter(User.id == user_id).first()
+    user = _get_by_pk(session, User, user_id)
     if user:
         print(f"取得: ユーザー ID={user.id}, 名前={user.name}, メール={user.email}, 電話={user.phone_number}")
     else:
@@ -319,31 +603,44 @@ def get_all_users(session) -> List[User]:
     if not users:
         print("ユーザーは存在しません。")
     for user in users:
-        user_info = {k: v for k, v in user.__dict__.items() if not k.startswith('_sa_')}
+        user_info = {c: getattr(user, c) for c in _USER_COLUMNS}
         print(f"ユーザー情報: {user_info}")
     print("----------------------")
     return users
 
 def update_user_info(session, user_id: int, new_email: Optional[str] = None, new_phone: Optional[str] = None) -> Optional[User]:
-    user = session.query(User).filter(User.id == user_id).first()
+    values: Dict[str, Any] = {}
+    if new_email:
+        values['email'] = new_email
+    if new_phone is not None:
+        values['phone_number'] = new_phone
+
+    if values:
+        from sqlalchemy import update
+        # SELECT してから変更するのではなく、UPDATE ... RETURNING の一文で更新後の行を受け取る
+        user = session.execute(
+            update(User).where(User.id == user_id).values(**values).returning(User)
+        ).scalar_one_or_none()
+    else:
+        user = _get_by_pk(session, User, user_id)
+
     if user:
-        if new_email:
-            user.email = new_email
-        if new_phone is not None:
-            user.phone_number = new_phone
+        # コミット後の属性アクセスで再 SELECT されないよう、先にメッセージを組み立てる
+        message = f"更新: ユーザー ID={user.id}, メール={user.email}, 電話={user.phone_number}"
         session.commit()
-        session.refresh(user)
-        print(f"更新: ユーザー ID={user.id}, メール={user.email}, 電話={user.phone_number}")
+        print(message)
     else:
         print(f"更新失敗: ユーザー ID={user_id} が見つかりません。")
     return user
 
 def delete_user(session, user_id: int):
-    user = session.query(User).filter(User.id == user_id).first()
-    if user:
-        session.delete(user)
+    from sqlalchemy import delete
+    deleted = session.execute(
+        delete(User).where(User.id == user_id).returning(User.id, User.name)
+    ).first()
+    if deleted:
         session.commit()
-        print(f"削除: ユーザー ID={user.id}, 名前={user.name}")
+        print(f"削除: ユーザー ID={deleted.id}, 名前={deleted.name}")
     else:
         print(f"削除失敗: ユーザー ID={user_id} が見つかりません。")
 
@@ -355,8 +652,18 @@ def create_product(session, name: str, price: int, category: Optional[str] = Non
     print(f"作成: 商品 ID={new_product.id}, 名前={new_product.name}, 価格={new_product.price}")
     return new_product
 
+def bulk_create_products(session, rows: List[Dict[str, Any]]) -> List[Product]:
+    """複数の商品を作成し、一度のコミットでまとめて保存します。"""
+    new_products = [Product(**row) for row in rows]
+    session.add_all(new_products)
+    session.flush() # コミット前に ID を採番させ、refresh による再取得を不要にする
+    for new_product in new_products:
+        print(f"作成: 商品 ID={new_product.id}, 名前={new_product.name}, 価格={new_product.price}")
+    session.commit()
+    return new_products
+
 def get_product_by_id(session, product_id: int) -> Optional[Product]:
-    product = session.query(Product).filter(Product.id == product_id).first()
+    product = _get_by_pk(session, Product, product_id)
     if product:
         print(f"取得: 商品 ID={product.id}, 名前={product.name}, 価格={product.price}")
     else:
@@ -364,23 +671,27 @@ def get_product_by_id(session, product_id: int) -> Optional[Product]:
     return product
 
 def update_product_price(session, product_id: int, new_price: int) -> Optional[Product]:
-    product = session.query(Product).filter(Product.id == product_id).first()
+    from sqlalchemy import update
+    # UPDATE ... RETURNING の一文で更新し、更新後の行を受け取る
+    product = session.execute(
+        update(Product).where(Product.id == product_id).values(price=new_price).returning(Product)
+    ).scalar_one_or_none()
     if product:
-        old_price = product.price
-        product.price = new_price
+        message = f"更新: 商品 ID={product.id}, 価格={product.price}"
         session.commit()
-        session.refresh(product)
-        print(f"更新: 商品 ID={product.id}, 価格: {old_price} -> {product.price}")
+        print(message)
     else:
         print(f"更新失敗: 商品 ID={product_id} が見つかりません。")
     return product
 
 def delete_product(session, product_id: int):
-    product = session.query(Product).filter(Product.id == product_id).first()
-    if product:
-        session.delete(product)
+    from sqlalchemy import delete
+    deleted = session.execute(
+        delete(Product).where(Product.id == product_id).returning(Product.id, Product.name)
+    ).first()
+    if deleted:
         session.commit()
-        print(f"削除: 商品 ID={product.id}, 名前={product.name}")
+        print(f"削除: 商品 ID={deleted.id}, 名前={deleted.name}")
     else:
         print(f"削除失敗: 商品 ID={product_id} が見つかりません。")
 
@@ -443,14 +754,18 @@ tables:
 
     # --- ステップ 2: models.py の生成 ---
     print("\n--- models.py を更新/生成中 ---")
-    try:
-        generated_code = generate_models_code(CURRENT_SCHEMA_YAML)
-        with open(MODELS_PY_PATH, 'w', encoding='utf-8') as f:
-            f.write(generated_code)
-        print(f"'{MODELS_PY_PATH}' が正常に生成/更新されました。")
-    except ValueError as e:
-        print(f"モデル生成エラー: {e}", file=sys.stderr)
-        sys.exit(1)
+    # スキーマと生成器のバージョンが前回の生成時から変わっていなければ、生成と書き込みを省略する
+    schema_hash = _schema_hash(CURRENT_SCHEMA_YAML)
+    if _read_schema_hash(MODELS_PY_PATH) == schema_hash:
+        print(f"スキーマと生成器に変更がないため、'{MODELS_PY_PATH}' の生成をスキップしました。")
+    else:
+        try:
+            generated_code = generate_models_code(CURRENT_SCHEMA_YAML)
+            pathlib.Path(MODELS_PY_PATH).write_text(f"{SCHEMA_HASH_PREFIX}{schema_hash}\n{generated_code}", encoding='utf-8')
+            print(f"'{MODELS_PY_PATH}' が正常に生成/更新されました。")
+        except ValueError as e:
+            print(f"モデル生成エラー: {e}", file=sys.stderr)
+            sys.exit(1)
 
     # --- ステップ 3: Alembic 環境のセットアップ ---
     setup_alembic()
@@ -468,12 +783,15 @@ tables:
 
     # --- ステップ 5: 生成されたモデルの動的ロード ---
     print("\n--- 生成されたモデルを動的ロード中 ---")
-    import importlib.util
     load_models_dynamically() # モデルがロードされる
 
     # --- ステップ 6: CRUD 操作の実行 ---
     print("\n--- データベース CRUD 操作 ---")
-    engine = create_engine(DATABASE_URL)
+    from sqlalchemy import create_engine, event, select
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", _set_sqlite_pragmas)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     session = SessionLocal()
 
@@ -482,21 +800,28 @@ tables:
         print("\n--- ユーザー操作 ---")
         if not session.query(User).first(): # ユーザーが一人もいない場合のみ初期データ追加
             print("初期ユーザーデータを追加します。")
-            create_user(session, "Alice", "alice@example.com", "090-1111-2222")
-            create_user(session, "Bob", "bob@example.com", None)
-            create_user(session, "Charlie", "charlie@example.com", "080-3333-4444")
+            bulk_create_users(session, [
+                {"name": "Alice", "email": "alice@example.com", "phone_number": "090-1111-2222"},
+                {"name": "Bob", "email": "bob@example.com", "phone_number": None},
+                {"name": "Charlie", "email": "charlie@example.com", "phone_number": "080-3333-4444"},
+            ])
         else:
             print("既存ユーザーが存在します。初期データの追加はスキップします。")
 
         get_all_users(session)
 
+        # 操作対象ユーザーの ID を一度のクエリでまとめて取得
+        user_ids = dict(session.execute(
+            select(User.name, User.id).where(User.name.in_(["Alice", "Bob"]))
+        ).all())
+
         # ユーザー1の情報を更新
-        if user1_id := session.query(User.id).filter(User.name == "Alice").scalar():
+        if user1_id := user_ids.get("Alice"):
             update_user_info(session, user1_id, new_email="alice.new@example.com", new_phone="070-9876-5432")
             get_user_by_id(session, user1_id)
         
         # ユーザー2を削除
-        if user2_id := session.query(User.id).filter(User.name == "Bob").scalar():
+        if user2_id := user_ids.get("Bob"):
             delete_user(session, user2_id)
         get_all_users(session)
 
@@ -504,16 +829,23 @@ tables:
         print("\n--- 商品操作 ---")
         if not session.query(Product).first(): # 商品が一つもいない場合のみ初期データ追加
             print("初期商品データを追加します。")
-            create_product(session, "Laptop", 120000, "Electronics", 50)
-            create_product(session, "Python Book", 3500, "Books", 200)
+            bulk_create_products(session, [
+                {"name": "Laptop", "price": 120000, "category": "Electronics", "stock_quantity": 50},
+                {"name": "Python Book", "price": 3500, "category": "Books", "stock_quantity": 200},
+            ])
         else:
             print("既存商品が存在します。初期データの追加はスキップします。")
 
-        if product_id := session.query(Product.id).filter(Product.name == "Laptop").scalar():
+        # 操作対象商品の ID を一度のクエリでまとめて取得
+        product_ids = dict(session.execute(
+            select(Product.name, Product.id).where(Product.name.in_(["Laptop", "Python Book"]))
+        ).all())
+
+        if product_id := product_ids.get("Laptop"):
             update_product_price(session, product_id, 110000)
             get_product_by_id(session, product_id)
         
-        if product_id := session.query(Product.id).filter(Product.name == "Python Book").scalar():
+        if product_id := product_ids.get("Python Book"):
             delete_product(session, product_id)
         get_product_by_id(session, product_id) # 削除確認
 